@@ -1,10 +1,17 @@
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
 import logging
-import multiprocessing as mp
+from pathlib import Path
+import tempfile
+import threading
+import time
 
 import cdsapi
-import humanize
+import xarray as xr
 
+from gwsc_ingest.utils.expver import combine_expver
+from gwsc_ingest.utils.files import atomic_output_path
 from gwsc_ingest.utils.logging import setup_basic_logging
 from gwsc_ingest.utils.validation import validate_directory
 
@@ -12,42 +19,69 @@ _COMMAND_DESCRIPTION = "Downloads multiple 24 hour reanalysis-era5-single-levels
                        "datasets, one for each day in the given date range."
 log = logging.getLogger(__name__)
 
+# Serializes the splitting of monthly files across download threads: concurrent reads and writes through the netCDF4
+# library crash in HDF5. Splitting is short next to the time spent queued at the CDS, so downloads still overlap.
+_SPLIT_LOCK = threading.Lock()
+
 
 def bulk_download_one_day_ran_sfc(days, download_dir, download_format='netcdf', processes=1, api_key=None):
     """
     Downloads multiple 24 hour reanalysis-era5-single-levels (ran-sfc) datasets,
-        one for each day in the given date range.
+        one for each day in the given date range. Days are grouped by month and each month is retrieved
+        with a single CDS request, which is then split into one file per day.
 
     Args:
         days (list<datetime.datetime>): Days to download as a list of datetime object with year, month, and day defined.
         download_dir (path): Path to directory where data will be downloaded to.
         download_format (str): Format data will be downloaded as: one of "netcdf" or "grib". Defaults to "netcdf".
-        processes (int): Number of concurrent processes to use to download the data.
+        processes (int): Number of concurrent downloads. Downloads are run in threads, because they spend
+            nearly all of their time waiting on the CDS.
         api_key (str): CDS API Key. Attempts to read from ~/.cdsapirc file if not provided.
     """
-    # Validate input
+    # Validate input once here instead of in every task
     if processes < 1:
         log.warning('"processes" should not be negative. Using to 1 process.')
         processes = 1
 
+    download_dir = validate_directory(download_dir, 'download_dir')
+
+    if download_format not in ['netcdf', 'grib']:
+        raise ValueError('"download_format" must be one of "netcdf" or "grib".')
+
     # Save current time for timing
-    start_time = dt.datetime.utcnow()
+    start_time = time.perf_counter()
 
-    # Build task arguments
-    tasks = []
+    # Group days by month: the CDS queues each request separately, so one request per month
+    # is much faster than one request per day. GRIB files can't be split, so request those per day.
+    days_by_request = defaultdict(list)
     for day in days:
         if not isinstance(day, dt.datetime):
             log.warning(f'Invalid day given: {day}. Must be a datetime.datetime object. Skipping...')
-        tasks.append((day, download_dir, download_format, api_key))
+            continue
+        if download_format == 'netcdf':
+            days_by_request[(day.year, day.month)].append(day)
+        else:
+            days_by_request[(day.year, day.month, day.day)].append(day)
+
+    # Build task arguments
+    tasks = [
+        _get_out_paths(sorted(request_days), download_dir, download_format)
+        for request_days in days_by_request.values()
+    ]
 
     # Execute
-    with mp.Pool(processes=processes) as p:
-        # This will block until finished
-        p.starmap(download_one_day_ran_sfc, tasks)
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(_retrieve_days_ran_sfc, out_paths, download_dir, download_format, api_key)
+            for out_paths in tasks
+        ]
+        # This will block until finished and raise the first exception encountered
+        for future in futures:
+            future.result()
 
     # Report time taken
-    time_to_download = dt.datetime.utcnow() - start_time
-    log.info(f'All downloads completed in {humanize.precisedelta(time_to_download)}')
+    time_to_download = time.perf_counter() - start_time
+    log.info(f'All downloads completed in {time_to_download:.1f} s')
 
 
 def download_one_day_ran_sfc(day, download_dir, download_format='netcdf', api_key=None):
@@ -58,29 +92,86 @@ def download_one_day_ran_sfc(day, download_dir, download_format='netcdf', api_ke
         day (datetime.datetime): Day to download. Datetime object with year, month, and day defined.
         download_dir (path): Path to directory where data will be downloaded to.
         download_format (str): Format data will be downloaded as: one of "netcdf" or "grib". Defaults to "netcdf".
+        api_key (str): CDS API Key. Attempts to read from ~/.cdsapirc file if not provided.
+    """
+    download_days_ran_sfc([day], download_dir, download_format, api_key)
+
+
+def download_days_ran_sfc(days, download_dir, download_format='netcdf', api_key=None):
+    """
+    Downloads 24 hours of the reanalysis-era5-single-levels (ran-sfc) data for each of the given days using
+        a single CDS request. The result is split into one file per day.
+
+    Args:
+        days (list<datetime.datetime>): Days to download. All days must be in the same month. Datetime objects
+            with year, month, and day defined.
+        download_dir (path): Path to directory where data will be downloaded to.
+        download_format (str): Format data will be downloaded as: one of "netcdf" or "grib". Defaults to "netcdf".
+            Only one day may be given when downloading in "grib" format.
+        api_key (str): CDS API Key. Attempts to read from ~/.cdsapirc file if not provided.
     """
     # Validate input
-    if not isinstance(day, dt.datetime):
-        raise ValueError('"day" must be a datetime.datetime object.')
+    if not days:
+        raise ValueError('"days" must contain at least one day.')
+
+    if not all(isinstance(day, dt.datetime) for day in days):
+        raise ValueError('"days" must be a list of datetime.datetime objects.')
+
+    if len({(day.year, day.month) for day in days}) > 1:
+        raise ValueError('"days" must all be in the same month.')
 
     download_dir = validate_directory(download_dir, 'download_dir')
 
     if download_format not in ['netcdf', 'grib']:
         raise ValueError('"download_format" must be one of "netcdf" or "grib".')
 
-    # Derive request params
-    year_str = day.strftime('%Y')
-    month_str = day.strftime('%m')
-    day_str = day.strftime('%d')
-    log.info(f'Retrieving 24 hours of data for date (Y-M-D): {year_str}-{month_str}-{day_str}')
+    if download_format == 'grib' and len(days) > 1:
+        raise ValueError('Only one day may be downloaded at a time in "grib" format.')
+
+    out_paths = _get_out_paths(days, download_dir, download_format)
+    _retrieve_days_ran_sfc(out_paths, download_dir, download_format, api_key)
+
+
+def _get_out_paths(days, download_dir, download_format):
+    """
+    Define the output file of each day.
 
-    # Define output filename and location
+    Args:
+        days (list<datetime.datetime>): Days to download.
+        download_dir (pathlib.Path): Path to directory where data will be downloaded to.
+        download_format (str): Format data will be downloaded as: one of "netcdf" or "grib".
+
+    Returns:
+        dict<datetime.datetime, pathlib.Path>: Path to the output file of each day.
+    """
     out_file_ext = 'nc' if download_format == 'netcdf' else 'grib'
-    out_filename = f'reanalysis-era5-single-levels-24-hours-{day:%Y-%m-%d}.{out_file_ext}'
-    out_path = download_dir / out_filename
+    return {
+        day: download_dir / f'reanalysis-era5-single-levels-24-hours-{day:%Y-%m-%d}.{out_file_ext}'
+        for day in days
+    }
+
+
+def _retrieve_days_ran_sfc(out_paths, download_dir, download_format, api_key):
+    """
+    Retrieve the given days with a single CDS request, without validating input.
+
+    Args:
+        out_paths (dict<datetime.datetime, pathlib.Path>): Path to the output file of each day to download.
+            All days must be in the same month.
+        download_dir (pathlib.Path): Path to an existing directory where data will be downloaded to.
+        download_format (str): Format data will be downloaded as: one of "netcdf" or "grib".
+        api_key (str): CDS API Key. Attempts to read from ~/.cdsapirc file if not provided.
+    """
+    # Derive request params
+    days = list(out_paths)
+    first_day = days[0]
+    year_str = first_day.strftime('%Y')
+    month_str = first_day.strftime('%m')
+    day_strs = [day.strftime('%d') for day in days]
+    log.info(f'Retrieving 24 hours of data for {len(days)} day(s) in month (Y-M): {year_str}-{month_str}')
 
     # Get start time for timing
-    start_time = dt.datetime.utcnow()
+    start_time = time.perf_counter()
 
     # Submit the download request using the CDS Python API
     if api_key is None:
@@ -91,37 +182,80 @@ def download_one_day_ran_sfc(day, download_dir, download_format='netcdf', api_ke
             key=api_key,
         )
 
-    if day > dt.datetime(1978, 12, 31):
+    if first_day > dt.datetime(1978, 12, 31):
         dataset_name = 'reanalysis-era5-single-levels'
     else:
         dataset_name = 'reanalysis-era5-single-levels-preliminary-back-extension'
 
-    r = cds.retrieve(
-        dataset_name,
-        {
-            'product_type': 'reanalysis',
-            'variable': [
-                '2m_temperature',
-                'total_precipitation',
-            ],
-            'year': year_str,
-            'month': [month_str],
-            'day': [day_str],
-            'time': [
-                '00:00', '01:00', '02:00', '03:00', '04:00', '05:00',
-                '06:00', '07:00', '08:00', '09:00', '10:00', '11:00',
-                '12:00', '13:00', '14:00', '15:00', '16:00', '17:00',
-                '18:00', '19:00', '20:00', '21:00', '22:00', '23:00',
-            ],
-            'format': download_format,
-        },
-        out_path
-    )
-    log.debug(r)
+    request = {
+        'product_type': 'reanalysis',
+        'variable': [
+            '2m_temperature',
+            'total_precipitation',
+        ],
+        'year': year_str,
+        'month': [month_str],
+        'day': day_strs,
+        'time': [
+            '00:00', '01:00', '02:00', '03:00', '04:00', '05:00',
+            '06:00', '07:00', '08:00', '09:00', '10:00', '11:00',
+            '12:00', '13:00', '14:00', '15:00', '16:00', '17:00',
+            '18:00', '19:00', '20:00', '21:00', '22:00', '23:00',
+        ],
+        'format': download_format,
+    }
+
+    if len(days) == 1:
+        # Single day: download directly to the output file
+        out_path = out_paths[first_day]
+        r = cds.retrieve(dataset_name, request)
+        log.debug(r)
+        _download_result(r, out_path)
+        log.info(f'Downloaded file: {out_path}')
 
-    time_to_download = dt.datetime.utcnow() - start_time
-    log.info(f'Downloaded file: {out_path}')
-    log.info(f'Download completed in {humanize.precisedelta(time_to_download)}')
+    else:
+        # Multiple days: download to temporary file and split into one file per day
+        with tempfile.TemporaryDirectory(dir=download_dir) as temp_dir:
+            temp_path = Path(temp_dir) / f'reanalysis-era5-single-levels-{year_str}-{month_str}.nc'
+            r = cds.retrieve(dataset_name, request)
+            log.debug(r)
+            _download_result(r, temp_path)
+            _split_days(temp_path, out_paths)
+
+    time_to_download = time.perf_counter() - start_time
+    log.info(f'Download completed in {time_to_download:.1f} s')
+
+
+def _split_days(in_path, out_paths):
+    """
+    Split a NetCDF file with multiple days of hourly data into one file per day. The CDS adds the expver dimension
+        to the whole file when the request mixes ERA5 and ERA5T data, so it is collapsed for each day.
+
+    Args:
+        in_path (pathlib.Path): Path to the NetCDF file to split.
+        out_paths (dict<datetime.datetime, pathlib.Path>): Path to the output file of each day in the file.
+    """
+    with _SPLIT_LOCK, xr.open_dataset(in_path) as ds:
+        for day, out_path in out_paths.items():
+            day_ds = ds.sel(time=f'{day:%Y-%m-%d}')
+            if 'expver' in day_ds.dims:
+                day_ds = combine_expver(day_ds)
+            with atomic_output_path(out_path) as part_path:
+                day_ds.to_netcdf(part_path)
+            log.info(f'Downloaded file: {out_path}')
+
+
+def _download_result(result, out_path):
+    """
+    Download the result of a completed CDS request, only moving it to the output path once it is complete.
+
+    Args:
+        result (cdsapi.api.Result): The result of the CDS request.
+        out_path (pathlib.Path): Path to the file the result will be written to.
+    """
+    # cdsapi handles timeouts, retries, and checks the downloaded size
+    with atomic_output_path(out_path) as part_path:
+        result.download(str(part_path))
 
 
 def _download_command(args):
@@ -148,7 +282,7 @@ def _add_download_parser_arguments(parser):
     parser.add_argument("download_dir",
                         help="Path to directory where data will be downloaded to.")
     parser.add_argument("-p" "--processes", dest="processes", type=int, required=False, default=1,
-                        help="Number of concurrent processes to use to download the files.")
+                        help="Number of concurrent downloads.")
     parser.add_argument("-k" "--key", dest="key", type=str, required=False, default=None,
                         help="The CDS UID and API Key for authentication provided in the following "
                              "format: <UID>:<API_KEY>.")
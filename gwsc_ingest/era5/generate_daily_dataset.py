@@ -1,13 +1,20 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
 import logging
-import multiprocessing as mp
 import os.path
+import re
+import time
 
-import humanize
+import h5netcdf
+import h5py
+import numba
 import numpy as np
 from tqdm import tqdm
 import xarray as xr
 
+from gwsc_ingest.utils.encoding import DAILY_ENCODING
+from gwsc_ingest.utils.expver import combine_expver
+from gwsc_ingest.utils.files import atomic_output_path
 from gwsc_ingest.utils.logging import setup_basic_logging
 from gwsc_ingest.utils.validation import validate_directory
 
@@ -16,6 +23,20 @@ _COMMAND_DESCRIPTION = "Process a directory of ERA5 NetCDF files containing tota
                        "daily summary dataset files."
 log = logging.getLogger(__name__)
 
+# HDF5 chunk cache used for each variable of the hourly files: one day of global hourly int16 data is ~50 MB
+_HDF5_CHUNK_CACHE = {
+    'rdcc_nbytes': 64 << 20,
+    'rdcc_nslots': 521,
+    'rdcc_w0': 0.75,
+}
+
+# Date of the hourly ERA5 files, parsed from their names
+_FILE_DATE_RE = re.compile(r'reanalysis-era5-single-levels-24-hours-(\d{4})-(\d{2})-(\d{2})\.nc')
+
+# Edge length of the grid tiles processed by _daily_reduce: five float64 accumulators of a 64 x 64 tile (~160 KB)
+# fit in L2 cache
+_TILE_SIZE = 64
+
 
 def bulk_generate_daily_datasets(in_directory, out_directory, processes=1):
     """
@@ -25,50 +46,54 @@ def bulk_generate_daily_datasets(in_directory, out_directory, processes=1):
     Args:
         in_directory (path): Path to directory containing ERA5 NetCDF files with tp and t2m variables.
         out_directory (path): Path to directory where summary files will be written to.
-        processes (int): Number of concurrent processes to use to process the files.
+        processes (int): Number of concurrent threads to use to process the files.
     """
     # Validate input
     in_directory = validate_directory(in_directory, 'in_directory')
     out_directory = validate_directory(out_directory, 'out_directory')
 
     # Save current time for timing
-    start_time = dt.datetime.utcnow()
-
-    # Build task arguments
-    tasks = []
-    for item in in_directory.iterdir():
-        if item.is_file() and 'nc' in item.suffix:
-            tasks.append({
-                'in_filename': str(item),
-                'out_filename': str(out_directory)}
-            )
-
-    log.debug(tasks)
-    log.debug(f'Num tasks: {len(tasks)}')
-
-    # Execute
-    with mp.Pool(processes=processes) as p:
+    start_time = time.perf_counter()
+
+    # Build task arguments, skipping files that have already been processed (e.g. when resuming a partial run)
+    in_filenames = []
+    out_filenames = []
+    file_dates = []
+    num_skipped = 0
+    with os.scandir(in_directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.endswith('.nc'):
+                try:
+                    file_date = _get_file_date(entry.path)
+                except ValueError:
+                    log.warning(f'Skipping file with unexpected name: {entry.path}')
+                    continue
+                out_filename = os.path.join(out_directory, _get_daily_filename(file_date))
+                if _summary_file_exists(out_filename):
+                    num_skipped += 1
+                    continue
+                in_filenames.append(entry.path)
+                out_filenames.append(out_filename)
+                file_dates.append(file_date)
+
+    if num_skipped:
+        log.info(f'Skipping {num_skipped} files with existing summary files.')
+    log.debug(in_filenames)
+    log.debug(f'Num tasks: {len(in_filenames)}')
+
+    # Execute: work is dominated by HDF5 I/O and numpy reductions, which release the GIL,
+    # so threads avoid the cost of forking and importing xarray in every worker process.
+    # Output paths are already resolved and checked, so the tasks skip straight to processing.
+    with ThreadPoolExecutor(max_workers=processes) as executor:
+        results = executor.map(_generate_daily_dataset, in_filenames, out_filenames, file_dates)
         # This will block until finished
-        for _ in tqdm(p.imap_unordered(_worker, tasks), total=len(tasks)):
+        for _ in tqdm(results, total=len(in_filenames)):
             pass
 
     # Report time taken
-    time_to_download = dt.datetime.utcnow() - start_time
-    log.info(f'Processed {len(tasks)} files in {humanize.precisedelta(time_to_download)} '
-             f'using {processes} processes.')
-
-
-def _worker(qwargs):
-    """
-    Worker function that parses out kwargs (dict) and calls generate_summary_files with them.
-
-    Args:
-        qwargs (dict): Keyword arguments of generate_summary_files.
-    """
-    generate_daily_datasets(
-        in_filename=qwargs.get('in_filename'),
-        out_filename=qwargs.get('out_filename'),
-    )
+    time_to_process = time.perf_counter() - start_time
+    log.info(f'Processed {len(in_filenames)} files in {time_to_process:.1f} s '
+             f'using {processes} threads.')
 
 
 def generate_daily_datasets(in_filename, out_filename):
@@ -82,118 +107,261 @@ def generate_daily_datasets(in_filename, out_filename):
         in_filename (str): Path to NetCDF file of ERA5 data with total precipitation (tp) and 2-meter
             temperature (t2m) variables.
         out_filename (str): Path to file or directory where summary file will be written to. If directory
-            is provided, the following naming convention will be applied using the first date in the file:
+            is provided, the following naming convention will be applied using the date of the file:
             reanalysis-era5-sfc-daily-%Y-%m-%d.nc
     """
     log.info(f'Processing file: {in_filename}')
 
+    # Derive date of the file from its name
+    file_date = _get_file_date(in_filename)
+    log.debug(file_date)
+
     # Derive out filename
-    file_date = None
     if os.path.isdir(out_filename):
         # Automatically generate out filename with date
-        file_date = dt.datetime.strptime(
-            os.path.basename(in_filename),
-            'reanalysis-era5-single-levels-24-hours-%Y-%m-%d.nc'
-        )
-        log.debug(file_date)
-        out_filename = os.path.join(out_filename, f'reanalysis-era5-sfc-daily-{file_date:%Y-%m-%d}.nc')
-        log.info(f'Writing results to: {out_filename} ...')
+        out_filename = os.path.join(out_filename, _get_daily_filename(file_date))
+    log.info(f'Writing results to: {out_filename} ...')
 
     # Check to see if given filename/generated filename is an existing file
-    if os.path.isfile(out_filename):
+    if _summary_file_exists(out_filename):
         log.warning(f'A summary file with name "{out_filename}" already exists. Skipping...')
         return
 
-    # Open file
-    with xr.load_dataset(in_filename) as ds:
+    _generate_daily_dataset(in_filename, out_filename, file_date)
+
+
+def _generate_daily_dataset(in_filename, out_filename, file_date):
+    """
+    Generate a summary file from an ERA5 NetCDF file, without resolving or checking the output path.
+
+    Args:
+        in_filename (str): Path to NetCDF file of ERA5 data with total precipitation (tp) and 2-meter
+            temperature (t2m) variables.
+        out_filename (str): Path to file where summary file will be written to.
+        file_date (datetime.datetime): Date of the data in the file.
+    """
+    log.debug(f'Summarizing "{in_filename}" into "{out_filename}"')
+
+    # Open file lazily, so the 24-hour reductions stream through dask chunks instead of
+    # loading the whole file into memory first. Chunk over space: every chunk holds the full day.
+    # Times are not decoded: the reductions only need the data, and the date comes from the file name.
+    # Scale and offset are still applied, because the hourly data is packed into integers.
+    with xr.open_dataset(_open_hourly_file(in_filename), chunks={'time': -1, 'latitude': 181, 'longitude': 360},
+                         decode_times=False) as ds:
         # Datasets with expver dimension have both ERA5 and ERA5T data
-        # ERA5 Data is assigned experiment version (expver) 1, while ERA5T expver is 5
-        # See: https://confluence.ecmwf.int/display/CUSF/ERA5+CDS+requests+which+return+a+mixture+of+ERA5+and+ERA5T+data
         if 'expver' in ds.dims:
             log.warning(f'\nDataset "{in_filename}" contains both ERA5 and ERA5T data. Resulting dataset will be '
                         f'a combination of both. See: https://confluence.ecmwf.int/display/CUSF/'
                         f'ERA5+CDS+requests+which+return+a+mixture+of+ERA5+and+ERA5T+data')
+            ds = combine_expver(ds)
+
+        # The reduction kernel needs all 24 hours of each grid cell in one chunk
+        ds = ds.chunk({'time': -1})
+
+        # Compute all summary statistics and unit conversions in a single pass over the data
+        mean_t2m_c, min_t2m_c, max_t2m_c, sum_tp_mm = xr.apply_ufunc(
+            _daily_reduce, ds.t2m, ds.tp,
+            input_core_dims=[['time'], ['time']],
+            output_core_dims=[[], [], [], []],
+            dask='parallelized',
+            output_dtypes=[ds.t2m.dtype, ds.t2m.dtype, ds.t2m.dtype, ds.tp.dtype],
+        )
+        t2m_c_long_name = ds.t2m.long_name.replace('metre', 'meter')
 
-            # Temperature is from expver 5 (ERA5T)
-            new_ds = ds.sel(expver=5)
-
-            # But the first 6 hours of precip are from expver 1 (ERA5)
-            precip_expver1 = ds.tp.sel(expver=1).isel(time=slice(None, 7))  # ERA5 portion
-            precip_expver5 = ds.tp.sel(expver=5).isel(time=slice(7, None))  # ERA5T portion
-            new_ds['tp'] = xr.concat([precip_expver1, precip_expver5], 'time')
-            ds = new_ds
-
-        # Convert temperature from K to C
-        ds['t2m_c'] = ds.t2m - 273.15
-        ds['t2m_c'].attrs['long_name'] = ds.t2m.long_name.replace('metre', 'meter')
-        ds['t2m_c'].attrs['units'] = 'C'
-
-        # Convert precipitation from meters to millimeters
-        ds['tp_mm'] = ds.tp * 1000
-        ds['tp_mm'].attrs['long_name'] = ds.tp.long_name
-        ds['tp_mm'].attrs['units'] = 'mm'
-
-        # Compute mean temperature
-        mean_t2m_c = ds.t2m_c.mean('time')
-        mean_t2m_c.attrs['long_name'] = 'Mean ' + ds.t2m_c.long_name
+        # Mean temperature
+        mean_t2m_c.attrs['long_name'] = 'Mean ' + t2m_c_long_name
         mean_t2m_c.attrs['units'] = 'C'
-        mean_t2m_c = add_time_dimension(mean_t2m_c, file_date)
         log.debug(f'\n----------Mean Temperature @ 2 Meters----------\n{mean_t2m_c}')
 
-        # Compute minimum temperature
-        min_t2m_c = ds.t2m_c.min('time')
-        min_t2m_c.attrs['long_name'] = 'Minimum ' + ds.t2m_c.long_name
+        # Minimum temperature
+        min_t2m_c.attrs['long_name'] = 'Minimum ' + t2m_c_long_name
         min_t2m_c.attrs['units'] = 'C'
-        min_t2m_c = add_time_dimension(min_t2m_c, file_date)
         log.debug(f'\n----------Min. Temperature @ 2 Meters----------\n{min_t2m_c}')
 
-        # Compute maximum temperature
-        max_t2m_c = ds.t2m_c.max('time')
-        max_t2m_c.attrs['long_name'] = 'Maximum ' + ds.t2m_c.long_name
+        # Maximum temperature
+        max_t2m_c.attrs['long_name'] = 'Maximum ' + t2m_c_long_name
         max_t2m_c.attrs['units'] = 'C'
-        max_t2m_c = add_time_dimension(max_t2m_c, file_date)
         log.debug(f'\n----------Max. Temperature @ 2 Meters----------\n{max_t2m_c}')
 
-        # Compute total precipitation
-        sum_tp_mm = ds.tp_mm.sum('time')
-        sum_tp_mm.attrs['long_name'] = ds.tp_mm.long_name
+        # Total precipitation
+        sum_tp_mm.attrs['long_name'] = ds.tp.long_name
         sum_tp_mm.attrs['units'] = 'mm'
-        sum_tp_mm = add_time_dimension(sum_tp_mm, file_date)
         log.debug(f'\n----------Sum of Total Precipitation @ Surface ----------\n{sum_tp_mm}')
 
-        # Create new Dataset with all summary variables
+        # Create new Dataset with all summary variables, adding the time dimension to all of them at once
         out_ds = xr.Dataset({
             'mean_t2m_c': mean_t2m_c,
             'max_t2m_c': max_t2m_c,
             'min_t2m_c': min_t2m_c,
             'sum_tp_mm': sum_tp_mm
         })
+        out_ds = add_time_dimension(out_ds, file_date)
         log.debug(out_ds)
 
-        out_ds.to_netcdf(out_filename)
+        # Compute all summary variables in one scheduler pass: they are outputs of the same kernel, so each block of
+        # the input is read once, and the write below only has to encode in-memory arrays
+        out_ds = out_ds.compute()
+
+        # Pack into integers and apply light compression: most of the size reduction at little extra CPU cost.
+        # Store each day as a single on-disk chunk, since the file is always read a whole day at a time.
+        chunksizes = (1, out_ds.sizes['latitude'], out_ds.sizes['longitude'])
+        encoding = {
+            var: {**DAILY_ENCODING.get(var, {}), 'zlib': True, 'complevel': 1, 'chunksizes': chunksizes}
+            for var in out_ds.data_vars
+        }
+        with atomic_output_path(out_filename) as part_filename:
+            out_ds.to_netcdf(part_filename, engine='h5netcdf', encoding=encoding)
+
+
+def _open_hourly_file(in_filename):
+    """
+    Open an hourly ERA5 file with an HDF5 chunk cache large enough to hold a full day of each variable, so the
+        chunks read for one block of the reduction are not evicted before the next block reuses them. NetCDF3 files
+        (e.g. single days downloaded directly from the CDS) are not HDF5 and are opened by xarray as usual.
+
+    Args:
+        in_filename (str): Path to NetCDF file of ERA5 data.
+
+    Returns:
+        xr.backends.H5NetCDFStore or str: Store to open with xr.open_dataset.
+    """
+    if not h5py.is_hdf5(in_filename):
+        return in_filename
+    return xr.backends.H5NetCDFStore(h5netcdf.File(in_filename, 'r', **_HDF5_CHUNK_CACHE))
+
+
+def _get_file_date(in_filename):
+    """
+    Get the date of an ERA5 hourly file from its name.
+
+    Args:
+        in_filename (str): Path to a file named reanalysis-era5-single-levels-24-hours-%Y-%m-%d.nc.
+
+    Returns:
+        datetime.datetime: The date of the file.
+
+    Raises:
+        ValueError: when the name of the file does not match the naming convention.
+    """
+    match = _FILE_DATE_RE.fullmatch(os.path.basename(in_filename))
+    if match is None:
+        raise ValueError(f'File name does not match "reanalysis-era5-single-levels-24-hours-%Y-%m-%d.nc": '
+                         f'{in_filename}')
+    return dt.datetime(int(match[1]), int(match[2]), int(match[3]))
+
+
+def _get_daily_filename(file_date):
+    """
+    Get the name of the summary file for the given date.
+
+    Args:
+        file_date (datetime.datetime): Date of the summary file.
+
+    Returns:
+        str: Name of the summary file.
+    """
+    return f'reanalysis-era5-sfc-daily-{file_date:%Y-%m-%d}.nc'
+
+
+def _summary_file_exists(out_filename):
+    """
+    Check if a summary file has already been written. Summary files are only moved to their final name once
+        completely written (see atomic_output_path), so interrupted runs leave no file behind to skip.
+
+    Args:
+        out_filename (str): Path to the summary file.
+
+    Returns:
+        bool: True if the summary file exists.
+    """
+    return os.path.isfile(out_filename)
+
+
+# Compiled code is cached on disk, so each run of the command doesn't pay the JIT compilation again.
+# Only reassociation and contraction are allowed: the full fastmath flag set assumes no NaNs, which would break
+# skipping missing values. The kernel is serial: it is called concurrently from dask threads and from the file thread
+# pool, and numba's parallel kernels can't be launched from concurrent threads (and would oversubscribe the cores).
+@numba.njit(fastmath={'reassoc', 'contract'}, cache=True)
+def _daily_reduce(t2m, tp):
+    """
+    Compute the daily summary statistics of one block of hourly data in a single pass, converting units on the fly.
+        NaN values are skipped, matching the xarray reductions. The grid is processed in tiles: time is walked in
+        the outer loop so each hourly slice of a tile is read in memory order, while the accumulators of the tile
+        stay in cache for all four statistics.
+
+    Args:
+        t2m (np.ndarray): 2-meter temperature in K with dimensions (latitude, longitude, time).
+        tp (np.ndarray): Total precipitation in m with dimensions (latitude, longitude, time).
+
+    Returns:
+        tuple<np.ndarray>: Mean, minimum, and maximum 2-meter temperature in C and total precipitation in mm,
+            each with dimensions (latitude, longitude).
+    """
+    nlat, nlon, ntime = t2m.shape
+    mean_c = np.empty((nlat, nlon), dtype=t2m.dtype)
+    min_c = np.empty((nlat, nlon), dtype=t2m.dtype)
+    max_c = np.empty((nlat, nlon), dtype=t2m.dtype)
+    sum_mm = np.empty((nlat, nlon), dtype=tp.dtype)
+
+    for i0 in range(0, nlat, _TILE_SIZE):
+        i1 = min(i0 + _TILE_SIZE, nlat)
+        for j0 in range(0, nlon, _TILE_SIZE):
+            j1 = min(j0 + _TILE_SIZE, nlon)
+            shape = (i1 - i0, j1 - j0)
+            count = np.zeros(shape, dtype=np.int64)
+            total = np.zeros(shape, dtype=np.float64)
+            lowest = np.full(shape, np.inf)
+            highest = np.full(shape, -np.inf)
+            precip = np.zeros(shape, dtype=np.float64)
+
+            # Accumulate over time for every cell of the tile
+            for k in range(ntime):
+                for i in range(i0, i1):
+                    for j in range(j0, j1):
+                        ti = i - i0
+                        tj = j - j0
+                        value = t2m[i, j, k]
+                        if not np.isnan(value):
+                            count[ti, tj] += 1
+                            total[ti, tj] += value
+                            lowest[ti, tj] = min(lowest[ti, tj], value)
+                            highest[ti, tj] = max(highest[ti, tj], value)
+                        value = tp[i, j, k]
+                        if not np.isnan(value):
+                            precip[ti, tj] += value
+
+            # Flush the tile to the outputs
+            for i in range(i0, i1):
+                for j in range(j0, j1):
+                    ti = i - i0
+                    tj = j - j0
+                    if count[ti, tj] > 0:
+                        mean_c[i, j] = total[ti, tj] / count[ti, tj] - 273.15
+                        min_c[i, j] = lowest[ti, tj] - 273.15
+                        max_c[i, j] = highest[ti, tj] - 273.15
+                    else:
+                        mean_c[i, j] = np.nan
+                        min_c[i, j] = np.nan
+                        max_c[i, j] = np.nan
+                    sum_mm[i, j] = precip[ti, tj] * 1000.0
+
+    return mean_c, min_c, max_c, sum_mm
 
 
 def add_time_dimension(data_array, time):
     """
-    Creates a new xr.DataArray with a time dimension with a single time.
+    Creates a new xr.DataArray or xr.Dataset with a time dimension with a single time.
 
     Args:
-        data_array (xr.DataArray): A 2D xr.DataArray with latitude and longitude coordinates.
+        data_array (xr.DataArray or xr.Dataset): A 2D xr.DataArray, or an xr.Dataset of 2D variables, with
+            latitude and longitude coordinates.
         time (datetime): A single datetime object.
 
     Returns:
-        xr.DataArray: The new array with the time dimension added.
+        xr.DataArray or xr.Dataset: The new array or dataset with the time dimension added.
     """
-    data_array = xr.DataArray(
-        np.array([data_array.data.copy()]),
-        coords=[
-            ('time', np.array([time])),
-            ('latitude', data_array.latitude.data.copy()),
-            ('longitude', data_array.longitude.data.copy())
-        ],
-        attrs=data_array.attrs,
-    )
-    return data_array
+    # Drop scalar coordinates (e.g. expver) and add the time axis without copying the data
+    return data_array.reset_coords(drop=True).expand_dims(time=[time])
 
 
 def _generate_daily_command(args):
@@ -209,7 +377,7 @@ def _add_generate_daily_parser_arguments(parser):
     parser.add_argument("out_directory",
                         help="Path to directory where summary files will be written to.")
     parser.add_argument("-p" "--processes", dest="processes", type=int, required=False, default=1,
-                        help="Number of concurrent processes to use to process the files.")
+                        help="Number of concurrent threads to use to process the files.")
 
     parser.add_argument("-d" "--debug", dest="debug", action='store_true',
                         help="Turn on debug logging.")
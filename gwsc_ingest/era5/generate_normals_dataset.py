@@ -1,14 +1,16 @@
-import copy
 import datetime as dt
 import logging
-import traceback
+import time
 
-import humanize
+import dask
+from dask.diagnostics import ProgressBar
+from flox.xarray import xarray_reduce
 import numpy as np
 import pandas as pd
-from tqdm import tqdm
 import xarray as xr
 
+from gwsc_ingest.utils.chunks import get_time_contiguous_chunks
+from gwsc_ingest.utils.encoding import DAILY_ENCODING, ZARR_COMPRESSOR, cast_packed_to_float32
 from gwsc_ingest.utils.logging import setup_basic_logging
 from gwsc_ingest.utils.validation import validate_directory
 
@@ -20,8 +22,24 @@ _COMMAND_DESCRIPTION = 'Compute the normal (day-of-year (DOY) mean) for given va
                        'to work with in systems that expect datetimes for a time-related dimension (e.g. THREDDS).'
 log = logging.getLogger(__name__)
 
+# Normals of the daily summary variables are packed into 16-bit integers on write, with the same precision as the
+# daily summaries (see _get_normal_packing). NetCDF output is compressed with shuffle + zlib, Zarr output with
+# the compressor of the other Zarr datasets.
+_NORMAL_NETCDF_ENCODING = {
+    'zlib': True,
+    'complevel': 4,
+    'shuffle': True,
+}
+_NORMAL_ZARR_ENCODING = {
+    'compressor': ZARR_COMPRESSOR,
+}
 
-def generate_normals_dataset(in_zarr, out_directory, variables=None, overwrite=False):
+# On-disk (HDF5) chunk shape of the per-DOY files: one time step and 180 x 360 grid cells (~128 KB of int16) per chunk
+_NORMAL_NETCDF_CHUNK_SHAPE = {'time': 1, 'latitude': 180, 'longitude': 360}
+
+
+def generate_normals_dataset(in_zarr, out_directory, variables=None, overwrite=False, processes=None,
+                             out_format='netcdf'):
     """
     Compute the normal (day-of-year (DOY) mean) for given variables in the provided Zarr dataset. Creates one
         xarray Dataset for each DOY, with dimensions "time", "latitude", and "longitude" and coordinates "time",
@@ -38,12 +56,20 @@ def generate_normals_dataset(in_zarr, out_directory, variables=None, overwrite=F
             all variables that are not dimension or coordinate variables will be processed.
         overwrite (bool): Overwrite existing output files if True. Defaults to False, skipping files/DOYs
             that already exist.
+        processes (int): Number of threads dask uses to compute the means. Defaults to the number of cores.
+        out_format (str): Format output will be written as: one of "netcdf" or "zarr". Defaults to "netcdf", which
+            writes one NetCDF file per DOY. "zarr" writes all DOYs to a single Zarr dataset named
+            reanalysis-era5-normal-pnt.zarr, with one time step per DOY.
 
     """
+    if out_format not in ['netcdf', 'zarr']:
+        raise ValueError('"out_format" must be one of "netcdf" or "zarr".')
+
     out_directory = validate_directory(out_directory)
     log.info(f'Results will be written to {out_directory}')
 
     with xr.open_zarr(in_zarr) as ds:
+        ds = cast_packed_to_float32(ds)
         log.debug(f'Given Dataset:\n{ds}')
 
         # Use all variable if not provided
@@ -54,176 +80,215 @@ def generate_normals_dataset(in_zarr, out_directory, variables=None, overwrite=F
 
         # Use first variable as template DataArray
         template_da = ds[variables[0]]
-        lats = template_da.latitude.data.copy()
-        lons = template_da.longitude.data.copy()
-
-        # Create lookup array of dates to assign to each doy
-        # THREDDS needs dates, so year 2000 chosen as an arbitrary leap year
-        # Prepend extra day to beginning so lookup can be 1-indexed instead of zero-indexed
-        datetime_for_ = pd.date_range(
-            start=dt.datetime(year=1999, month=12, day=31),
-            end=dt.datetime(year=2000, month=12, day=31),
-            freq='D'
-        ).to_list()
-
-        # Track failed doy mean computations
-        failed = {v: [] for v in variables}
-        ref_period_start = ds["time"][0].dt.strftime('%Y-%m-%d').item()
-        ref_period_end = ds["time"][-1].dt.strftime('%Y-%m-%d').item()
-
-        # Group data by day-of-year
-        doy_groups = template_da.groupby("time.dayofyear").groups
-        doy_group_indices = [(d, i) for d, i in doy_groups.items()]
-
-        for doy, doy_indices in tqdm(doy_group_indices):
-            # Get arbitrary date for given day-of-year
-            doy_date = datetime_for_[doy]
-
-            # Build up data_vars arg for dataset
-            data_vars = dict()
-
-            # Determine output file format
-            out_file = out_directory / \
-                       f'reanalysis-era5-normal-pnt-{doy_date:%Y-%m-%d}.nc'
-
-            if out_file.is_file():
-                if not overwrite:
-                    log.info(f'\nOutput for doy {doy} found at: {out_file}. Skipping...')
-                    continue
-                else:
-                    out_file.unlink(missing_ok=True)
-
-            for variable in variables:
-                # Start computation for current DOY
-                log.info(f'\nComputing mean for DOY {doy} for variable {variable}...')
-                comp_start_time = dt.datetime.utcnow()
-
-                # Compute mean for the current doy for all variables in parallel
-                result = _compute_doy_mean(variable, ds[variable], doy, doy_indices, doy_date,
-                                           ref_period_start, ref_period_end)
-
-                if result['success'] is None:
-                    log.info(f'An unexpected error occurred while processing {variable} for DOY {doy}')
-                    failed[variable].append(str(doy))
-                    continue
-                if result['success'] is False:
-                    log.error(f'An error occurred while processing mean for {variable} for DOY {doy}:\n'
-                              f'{result["result"]["exception"]}\n'
-                              f'{result["result"]["traceback"]}')
-                    failed[variable].append(str(doy))
-                    continue
-
-                result_da = result['result']
-                log.info(f'Mean computation for DOY {doy} for {variable} took '
-                         f'{humanize.naturaldelta(dt.datetime.utcnow() - comp_start_time)}')
-
-                data_vars.update({result_da.attrs['long_name']: result_da})
-
-            # Create dataset for writing - write one file for each DOY
-            out_ds = xr.Dataset(
-                data_vars=data_vars,
-                attrs={
-                    'reference_period_start': ref_period_start,
-                    'reference_period_end': ref_period_end,
-                }
-            )
-            out_ds = out_ds.chunk(chunks={'time': 1, 'latitude': len(lats), 'longitude': len(lons)})
-            log.info(f'Out DataSet:\n'
-                     f'{out_ds}')
-
-            log.info(f'Writing output: {out_file}')
-            out_ds.to_netcdf(out_file)
-            log.info(f'Processing complete for {variable} for DOY {doy}.')
-
-        # Log summary of failed processing
-        has_failures = False
-        for variable, failed_doys in failed.items():
-            if not failed_doys:
-                continue
-            has_failures = True
-            log.warning(f'Processing failed for the following DOYs for {variable}: '
-                        f'{" ".join(failed_doys)}')
 
-        if has_failures:
-            log.warning(f'Process completed with failures. Please re-run to correct failures and continue.')
-            exit(1)
+        # Put all time steps of a grid cell in the same chunk, so every chunk holds all years of each DOY and the
+        # means are reduced within chunks without combining partial results across time. Stores made by
+        # era5-rechunk-for-time are already chunked this way. Either input layout works; the DOY outputs are
+        # rechunked before writing (see below).
+        if template_da.chunks is not None and len(template_da.chunksizes['time']) > 1:
+            time_chunks = get_time_contiguous_chunks(template_da)
+            log.info(f'Input dataset is chunked along "time". Rechunking to: {time_chunks}')
+            ds = ds.chunk(time_chunks)
 
+        ref_period_start = ds["time"][0].dt.strftime('%Y-%m-%d').item()
+        ref_period_end = ds["time"][-1].dt.strftime('%Y-%m-%d').item()
 
-def _compute_doy_mean(variable, da, doy, doy_indices, doy_date, ref_start, ref_end):
+        # Lazily compute the day-of-year mean of all variables in a single grouped reduction. The "cohorts" method
+        # reduces time chunks that share day-of-year labels together, so each chunk of the input is read once for all
+        # DOYs. Within a chunk, the "flox" engine sorts time steps by DOY and sums every group in one np.add.reduceat
+        # pass. The expected groups are the DOYs present in the data, so DOY 366 is only one of them when the reference
+        # period has a leap day.
+        day_of_year = _get_day_of_year(ds['time'])
+        normals = xarray_reduce(ds[variables], day_of_year, func='mean',
+                                expected_groups=np.unique(day_of_year.values), method='cohorts', engine='flox')
+
+        out_ds = _build_normals_dataset(ds, normals, variables, ref_period_start, ref_period_end)
+
+        # Hold each DOY in a single dask chunk before splitting it into outputs. Otherwise every DOY keeps the spatial
+        # chunks of the input, and each output is written as many small partial writes into its compressed chunks.
+        # With time-contiguous input and NetCDF output this took 90.5 s, against 8.8 s rechunked.
+        out_ds = out_ds.chunk({'time': 1, 'latitude': -1, 'longitude': -1})
+        log.debug(f'Out DataSet:\n{out_ds}')
+
+        if out_format == 'zarr':
+            writes = _delayed_write_normals_zarr(out_ds, out_directory, overwrite)
+        else:
+            writes = _delayed_write_normals_netcdf(out_ds, out_directory, overwrite)
+
+        # Compute the means and write all outputs in one scheduler run, so reads of the input and the reduction overlap
+        # with the writes. NetCDF writes are serialized by h5py (see _delayed_write_normals_netcdf).
+        log.info('Computing and writing day-of-year means...')
+        start_time = time.perf_counter()
+        with ProgressBar():
+            dask.compute(*writes, scheduler='threads', num_workers=processes)
+        time_to_compute = time.perf_counter() - start_time
+        log.info(f'Day-of-year mean computation took {time_to_compute:.1f} s')
+
+
+def _build_normals_dataset(ds, normals, variables, ref_start, ref_end):
     """
-    Compute the DOY mean on the given data array, using the given doy_indices to retrieve the values for the
-        given doy and complete the computation. This was originally split into a separate function so that the process
-        could be multi-processed. However, the calculation appears to be disk bound, meaning multi-processing won't
-        improve performance unless the input Zarr dataset is stored on a distributed data storage system.
+    Build the output dataset from the computed DOY means, replacing the "dayofyear" dimension with a "time" dimension
+        of arbitrary dates from the year 2000 and a secondary "doy" coordinate.
 
     Args:
-        variable (str): Name of the variable. Used to create the name of the output DataArray.
-        da (xr.DataArray): The xr.DataArray containing the dataset on which to compute the DOY mean.
-        doy (int):  Day of year to compute the mean.
-        doy_indices (list): Time indices of all times corresponding with the DOY.
-        doy_date (np.datetime): Datetime corresponding with the DOY.
+        ds (xr.Dataset): The xr.Dataset the DOY means were computed from. Used for attributes.
+        normals (xr.Dataset): The (lazy) DOY means with dimensions "dayofyear", "latitude", and "longitude".
+        variables (iterable): Names of the variables the DOY means were computed for.
         ref_start (str): Datetime string of the start of the reference period.
         ref_end (str): Datetime string of the end of the reference period.
 
     Returns:
-        xr.DataArray or None:
+        xr.Dataset: Dataset with one "normal_<variable>" variable per variable and one time step per DOY.
     """
-    result = {
-        'success': None,
-        'result': None
-    }
-
-    try:
-        # Trigger mean computation
-        group_da = da.isel({'time': doy_indices})
-        mean_da = group_da.mean('time').compute()
-
-        # Coords
-        times = np.array([doy_date])
-        doys = np.array([np.int16(doy)])
-        lats = da.latitude.data
-        lons = da.longitude.data
-
+    # Create lookup array of dates to assign to each doy
+    # THREDDS needs dates, so year 2000 chosen as an arbitrary leap year
+    # Prepend extra day to beginning so lookup can be 1-indexed instead of zero-indexed
+    datetime_for_ = pd.date_range(
+        start=dt.datetime(year=1999, month=12, day=31),
+        end=dt.datetime(year=2000, month=12, day=31),
+        freq='D'
+    )
+    doys = normals['dayofyear'].values
+
+    data_vars = dict()
+    for variable in variables:
         # Attrs
         doy_mean_name = 'normal_' + variable
-        attrs = copy.deepcopy(da.attrs)
+        attrs = dict(ds[variable].attrs)
         attrs['long_name'] = doy_mean_name
         attrs['reference_period_start'] = ref_start
         attrs['reference_period_end'] = ref_end
+        data_vars[doy_mean_name] = normals[variable].assign_attrs(attrs)
 
-        mean_da_doy = xr.DataArray(
-            np.array([mean_da.data]),
-            coords={
-                'time': times,
-                'latitude': lats,
-                'longitude': lons,
-                'doy': ('time', doys),
-            },
-            dims=['time', 'latitude', 'longitude'],
-            attrs=attrs
-        )
-
-        result['success'] = True
-        result['result'] = mean_da_doy
-
-    except KeyboardInterrupt:
-        exit(1)
-
-    except Exception as e:
-        result['success'] = False
-        result['result'] = {
-            'exception': str(e),
-            'traceback': traceback.format_exc()
+    out_ds = xr.Dataset(
+        data_vars=data_vars,
+        attrs={
+            'reference_period_start': ref_start,
+            'reference_period_end': ref_end,
         }
+    )
+    out_ds = out_ds.rename({'dayofyear': 'time'}).assign_coords(
+        time=datetime_for_[doys],
+        doy=('time', doys.astype(np.int16)),
+    )
+    return out_ds.transpose('time', 'latitude', 'longitude')
+
+
+def _delayed_write_normals_netcdf(out_ds, out_directory, overwrite):
+    """
+    Prepare one NetCDF file for each DOY, deferring the computation and writing of the data.
+
+    Args:
+        out_ds (xr.Dataset): Lazy dataset with one time step per DOY, with one dask chunk per DOY.
+        out_directory (pathlib.Path): Path to directory where output will be written.
+        overwrite (bool): Overwrite existing output files if True, otherwise skip DOYs whose file already exists.
+
+    Returns:
+        list: dask.delayed.Delayed object that writes the data of all files when computed. Empty when all files are
+            skipped.
+    """
+    # Set the encoding on the variables, so that it carries over to each per-DOY slice written by save_mfdataset
+    chunksizes = tuple(
+        min(_NORMAL_NETCDF_CHUNK_SHAPE[dim], out_ds.sizes[dim]) for dim in ('time', 'latitude', 'longitude')
+    )
+    out_ds = out_ds.copy()
+    for var in out_ds.data_vars:
+        out_ds[var].encoding = {**_get_normal_packing(var), **_NORMAL_NETCDF_ENCODING, 'chunksizes': chunksizes}
+
+    out_datasets = []
+    out_paths = []
+    skipped = 0
+    for i, doy_date in enumerate(out_ds.indexes['time']):
+        doy = out_ds['doy'].values[i]
+        out_file = out_directory / f'reanalysis-era5-normal-pnt-{doy_date:%Y-%m-%d}.nc'
+
+        if out_file.is_file():
+            if not overwrite:
+                log.debug(f'Output for doy {doy} found at: {out_file}. Skipping...')
+                skipped += 1
+                continue
+            else:
+                out_file.unlink(missing_ok=True)
+
+        log.debug(f'Preparing output: {out_file}')
+        out_datasets.append(out_ds.isel(time=[i]))
+        out_paths.append(out_file)
+
+    if skipped:
+        log.info(f'Skipping {skipped} DOYs with existing output files.')
+
+    if not out_datasets:
+        return []
+
+    # Write with h5netcdf: h5py serializes all HDF5 calls behind its own global lock, so the files can be written from
+    # the threads of the dask scheduler. Concurrent writes through the netCDF4 engine crash in the HDF5 library.
+    return [xr.save_mfdataset(out_datasets, out_paths, engine='h5netcdf', compute=False)]
+
 
-    return result
+def _delayed_write_normals_zarr(out_ds, out_directory, overwrite):
+    """
+    Prepare a single Zarr dataset for all DOYs, deferring the computation and writing of the data.
+
+    Args:
+        out_ds (xr.Dataset): Lazy dataset with one time step per DOY, with one dask chunk per DOY.
+        out_directory (pathlib.Path): Path to directory where output will be written.
+        overwrite (bool): Overwrite an existing Zarr dataset if True, otherwise skip writing.
+
+    Returns:
+        list: dask.delayed.Delayed object that writes the data when computed. Empty when writing is skipped.
+    """
+    out_zarr = out_directory / 'reanalysis-era5-normal-pnt.zarr'
+
+    if out_zarr.exists() and not overwrite:
+        log.info(f'Output found at: {out_zarr}. Skipping...')
+        return []
+
+    # Store each DOY as a single chunk, matching the dask chunks, so reading one DOY touches one chunk per variable
+    # like the per-DOY NetCDF files
+    chunks = (1, out_ds.sizes['latitude'], out_ds.sizes['longitude'])
+    encoding = {
+        var: {**_get_normal_packing(var), **_NORMAL_ZARR_ENCODING, 'chunks': chunks} for var in out_ds.data_vars
+    }
+
+    log.info(f'Preparing output: {out_zarr}')
+    return [out_ds.to_zarr(out_zarr, mode='w', consolidated=True, encoding=encoding, compute=False)]
+
+
+def _get_normal_packing(normal_name):
+    """
+    Get the int16 packing of a normal variable from the encoding of the daily summary variable it was computed from.
+
+    Args:
+        normal_name (str): Name of the normal variable (e.g. "normal_sum_tp_mm").
+
+    Returns:
+        dict: The packing encoding, or an empty dict for variables that aren't daily summary variables.
+    """
+    variable = normal_name[len('normal_'):] if normal_name.startswith('normal_') else normal_name
+    return DAILY_ENCODING.get(variable, {})
+
+
+def _get_day_of_year(time):
+    """
+    Get the day of year (DOY) of each time step as int16 labels, computed directly from the datetime64 values.
+
+    Args:
+        time (xr.DataArray): The "time" coordinate of the dataset.
+
+    Returns:
+        xr.DataArray: The 1-indexed DOY of each time step, named "dayofyear", along the "time" dimension.
+    """
+    days = time.values.astype('datetime64[D]')
+    doys = (days - days.astype('datetime64[Y]')).astype(np.int16) + 1
+    return xr.DataArray(doys, dims='time', name='dayofyear')
 
 
 def _generate_normal_command(args):
     log_level = logging.DEBUG if args.debug else logging.INFO
     setup_basic_logging(log_level)
     log.debug(f'Given arguments: {args}')
-    generate_normals_dataset(args.in_zarr, args.out_directory, args.variables, args.overwrite)
+    generate_normals_dataset(args.in_zarr, args.out_directory, args.variables, args.overwrite, args.processes,
+                             args.out_format)
 
 
 def _add_generate_normal_arguments(parser):
@@ -238,6 +303,11 @@ def _add_generate_normal_arguments(parser):
     parser.add_argument("-o", "--overwrite", action="store_true", default=False,
                         help="Overwrite existing output files if True. Defaults to False, skipping files/DOYs "
                              "that already exist.")
+    parser.add_argument("-p", "--processes", type=int, default=None,
+                        help="Number of threads used to compute the means. Defaults to the number of cores.")
+    parser.add_argument("-f", "--format", dest="out_format", choices=['netcdf', 'zarr'], default='netcdf',
+                        help='Format output will be written as: "netcdf" writes one file per DOY, "zarr" writes all '
+                             'DOYs to a single Zarr dataset. Defaults to "netcdf".')
     parser.add_argument("-d" "--debug", dest="debug", action='store_true',
                         help="Turn on debug logging.")
     parser.set_defaults(func=_generate_normal_command)
@@ -1,10 +1,15 @@
+from contextlib import contextmanager
 import logging
 import math
+import os
 
-import humanize
-from tqdm import trange
+import dask
+from dask.diagnostics import ProgressBar
+from dask.utils import format_bytes
 import xarray as xr
+import zarr
 
+from gwsc_ingest.utils.encoding import DAILY_ENCODING, ZARR_COMPRESSOR
 from gwsc_ingest.utils.logging import setup_basic_logging
 from gwsc_ingest.utils.validation import validate_directory
 
@@ -28,54 +33,98 @@ def netcdf_to_zarr(in_directory, out_zarr, size_per_chunk=1.049e8):
     """
     in_directory = validate_directory(in_directory)
     log.info('Identifying files...')
-    nc_files = sorted([item for item in in_directory.iterdir() if item.is_file() and 'nc' in item.suffix])
+    with os.scandir(in_directory) as entries:
+        nc_files = [in_directory / name for name in
+                    sorted(entry.name for entry in entries if entry.is_file() and entry.name.endswith('.nc'))]
     num_files = len(nc_files)
     log.info(f'Found {num_files} files.')
 
     # Compute chunk sizes using first files as a template
     template_dataset = nc_files[0]
     log.info(f'Using "{template_dataset}" as the template dataset:')
-    with xr.load_dataset(template_dataset) as ds:
+    # Open lazily: sizes and dtypes come from the file metadata, so no data needs to be read
+    with xr.open_dataset(template_dataset, engine='h5netcdf') as ds:
         log.debug(ds)
 
-        # Estimate size of dset
-        size_per_ds = 0
-        for var in ds.variables:
-            var_size = ds[var].size * ds[var].data.itemsize
-            log.debug(f'{var}: {humanize.naturalsize(var_size)}')
-
-            # Skip dimension variables for ds size estimate
-            if var in ds.dims:
-                continue
-
-            size_per_ds += var_size
+        # Estimate size of dset from the data variables, skipping dimension variables
+        size_per_ds = sum(da.nbytes for da in ds.data_vars.values())
+        if log.isEnabledFor(logging.DEBUG):
+            for var in ds.variables:
+                log.debug(f'{var}: {format_bytes(ds[var].nbytes)}')
 
         ds_per_chunk = math.ceil(size_per_chunk / size_per_ds)
         num_chunks = math.ceil(num_files / ds_per_chunk)
-        log.info(f'Size per dataset: {humanize.naturalsize(size_per_ds)}')
+        log.info(f'Size per dataset: {format_bytes(size_per_ds)}')
         log.info(f'Chunk datasets: {ds_per_chunk} datasets')
-        log.info(f'Chunk size: {humanize.naturalsize(ds_per_chunk * size_per_ds)}')
+        log.info(f'Chunk size: {format_bytes(ds_per_chunk * size_per_ds)}')
         log.info(f'Num chunks: {num_chunks}')
 
-    for i in trange(num_chunks):
-        fstart = i * ds_per_chunk
-        fstop = (i + 1) * ds_per_chunk
-        fstop = int(min(fstop, num_files))
-
+    # The daily summary files are only read, so HDF5 file locking only adds overhead to each open
+    with _hdf5_file_locking_disabled():
+        # Open all files lazily in parallel with dask. Only variables with a time dimension are concatenated, and
+        # the remaining coordinates (latitude, longitude) are taken from the first file instead of being compared
+        # across all files: every daily summary file is on the same grid. The files are written with h5netcdf, which
+        # reads each file with its own handle, so the global lock of the netCDF4 engine isn't needed.
         combined_ds = xr.open_mfdataset(
-            nc_files[fstart:fstop],
+            nc_files,
+            engine='h5netcdf',
+            lock=False,
             combine='by_coords',
-            concat_dim='time',
+            data_vars='minimal',
+            coords='minimal',
+            compat='override',
+            parallel=True,
         )
 
         # Re-chunk by time
         combined_ds = combined_ds.chunk(chunks={'time': ds_per_chunk})
         log.debug(combined_ds)
 
-        if i == 0:
-            combined_ds.to_zarr(out_zarr, consolidated=True, mode='w')
+        # Pack the summary variables into int16 like the daily summary files, whatever the encoding of the files read
+        encoding = {var: {**DAILY_ENCODING.get(var, {}), 'compressor': ZARR_COMPRESSOR}
+                    for var in combined_ds.data_vars}
+
+        # Initialize the store with the final time axis. Metadata and coordinates are written now, the data of each
+        # chunk is written below with region writes that don't touch the metadata.
+        combined_ds.to_zarr(out_zarr, mode='w', compute=False, consolidated=False, encoding=encoding)
+
+        # Variables without a time dimension are fully written by the initialization
+        region_ds = combined_ds.drop_vars([var for var in combined_ds.variables if 'time' not in combined_ds[var].dims])
+
+        writes = []
+        for i in range(num_chunks):
+            fstart = i * ds_per_chunk
+            fstop = (i + 1) * ds_per_chunk
+            fstop = int(min(fstop, num_files))
+
+            # Each region covers exactly one Zarr chunk along time, so the writes are independent of each other
+            region = {'time': slice(fstart, fstop)}
+            writes.append(region_ds.isel(region).to_zarr(out_zarr, region=region, consolidated=False, compute=False))
+
+        # Read, encode, and write all chunks in one scheduler run, so reading the files of one chunk overlaps with
+        # compressing and writing others
+        with ProgressBar():
+            dask.compute(*writes, scheduler='threads')
+
+    # Consolidate metadata once, now that the store is complete
+    zarr.consolidate_metadata(out_zarr)
+
+
+@contextmanager
+def _hdf5_file_locking_disabled():
+    """
+    Disable HDF5 file locking for the files opened within the context, unless HDF5_USE_FILE_LOCKING is already set.
+        The previous value is restored on exit, so files written afterwards in the same process are still locked.
+    """
+    previous = os.environ.get('HDF5_USE_FILE_LOCKING')
+    os.environ.setdefault('HDF5_USE_FILE_LOCKING', 'FALSE')
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop('HDF5_USE_FILE_LOCKING', None)
         else:
-            combined_ds.to_zarr(out_zarr, consolidated=True, append_dim='time')
+            os.environ['HDF5_USE_FILE_LOCKING'] = previous
 
 
 def _netcdf_to_zarr_command(args):
@@ -1,13 +1,18 @@
-import datetime as dt
 import logging
 from pathlib import Path
 from pprint import pformat
 import shutil
+import time
 
-import humanize
+from dask.system import CPU_COUNT
+from dask.utils import format_bytes, parse_bytes
+import psutil
 from rechunker import rechunk
 import xarray as xr
+import zarr
 
+from gwsc_ingest.utils.chunks import get_time_contiguous_chunks
+from gwsc_ingest.utils.encoding import ZARR_COMPRESSOR, cast_packed_to_float32
 from gwsc_ingest.utils.logging import setup_basic_logging
 
 _COMMAND_DESCRIPTION = 'Rechunk a dataset such that all time steps for a given location in the grid are contained ' \
@@ -15,7 +20,7 @@ _COMMAND_DESCRIPTION = 'Rechunk a dataset such that all time steps for a given l
 log = logging.getLogger(__name__)
 
 
-def rechunk_for_time(in_zarr, out_zarr, temp_zarr, max_memory):
+def rechunk_for_time(in_zarr, out_zarr, temp_zarr, max_memory=None):
     """
     Rechunk a dataset such that all time steps for a given location in the grid are contained in a
        single chunk to allow for more efficient time-series analysis.
@@ -25,7 +30,10 @@ def rechunk_for_time(in_zarr, out_zarr, temp_zarr, max_memory):
             "time", "latitude", and "longitude".
         out_zarr (str): Path to address where output Zarr dataset will be written.
         temp_zarr (str): Path to address where a temporary intermediate Zarr dataset will be written.
-        max_memory (str): Maximum in-memory size of chunk. Defaults to "100MB".
+        max_memory (str): Maximum in-memory size of chunk (e.g. "500MB"). This is a limit per worker: the copy runs
+            on dask's threaded scheduler with one worker per core. Defaults to half of the available memory split
+            between the workers, which lets rechunker copy the data in fewer passes through the intermediate
+            dataset.
     """
     # Clean up
     out_zarr_path = Path(out_zarr)
@@ -36,17 +44,21 @@ def rechunk_for_time(in_zarr, out_zarr, temp_zarr, max_memory):
     if temp_zarr_path.is_dir():
         shutil.rmtree(temp_zarr_path)
 
+    if max_memory is None:
+        max_memory = int(psutil.virtual_memory().available * 0.5 / CPU_COUNT)
+        log.info(f'Using up to {format_bytes(max_memory)} of memory per worker for rechunking '
+                 f'({CPU_COUNT} workers).')
+
     with xr.open_zarr(in_zarr) as ds:
+        ds = cast_packed_to_float32(ds)
         log.debug(ds)
         log.debug(f'Dimensions: {ds.dims}')
 
-        # TODO: Compute lat/lon chunk size
-
-        chunks_per_var = {
-            'time': ds.time.size,
-            'latitude': 7,  # Factors of 721 = 1 x 7 x 103
-            'longitude': 180,  # Factors of 1440 = 1 x 2^5 x 3^2 x 5
-        }
+        # Size chunks from the data, using the first data variable as the template. Chunks are kept to at most
+        # 100 MB, and never larger than the memory given to rechunker.
+        template_da = ds[list(ds.data_vars)[0]]
+        target_chunk_size = min(parse_bytes(max_memory), 1.049e8)
+        chunks_per_var = get_time_contiguous_chunks(template_da, target_chunk_size)
 
         target_chunks = dict()
         for var in ds.variables:
@@ -55,37 +67,45 @@ def rechunk_for_time(in_zarr, out_zarr, temp_zarr, max_memory):
             else:
                 target_chunks[var] = None
 
-        log.debug(f'Target Chunks:\n{pformat(target_chunks)}')
-
-        target_chunks_size = dict()
-        for var in target_chunks:
-            var_data = target_chunks[var]
-            if var_data is not None:
-                items_per_chunk = var_data['time'] * var_data['latitude'] * var_data['longitude']
-                var_item_size = ds[var].data.itemsize
-                target_chunks_size[var] = {
-                    'chunk_size': humanize.naturalsize(items_per_chunk * var_item_size),
-                    'item_size': humanize.naturalsize(var_item_size),
-                    'items_per_chunk': items_per_chunk,
-                }
-            else:
-                target_chunks_size[var] = None
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'Target Chunks:\n{pformat(target_chunks)}')
 
-        log.debug(f'Target Chunks Size:\n{pformat(target_chunks_size)}')
+            target_chunks_size = dict()
+            for var in target_chunks:
+                var_data = target_chunks[var]
+                if var_data is not None:
+                    items_per_chunk = var_data['time'] * var_data['latitude'] * var_data['longitude']
+                    var_item_size = ds[var].dtype.itemsize
+                    target_chunks_size[var] = {
+                        'chunk_size': format_bytes(items_per_chunk * var_item_size),
+                        'item_size': format_bytes(var_item_size),
+                        'items_per_chunk': items_per_chunk,
+                    }
+                else:
+                    target_chunks_size[var] = None
+
+            log.debug(f'Target Chunks Size:\n{pformat(target_chunks_size)}')
+
+        compressor_options = {var: {'compressor': ZARR_COMPRESSOR} for var in ds.data_vars}
 
         array_plan = rechunk(
             source=ds,
             target_chunks=target_chunks,
             max_mem=max_memory,
             target_store=out_zarr,
+            target_options=compressor_options,
             temp_store=temp_zarr,
+            temp_options=compressor_options,
         )
 
         log.info('Executing...')
-        start_time = dt.datetime.utcnow()
+        start_time = time.perf_counter()
         array_plan.execute()
-        compute_time = dt.datetime.utcnow() - start_time
-        log.debug(f'Done. Execution took: {humanize.naturaldelta(compute_time)}')
+        compute_time = time.perf_counter() - start_time
+        log.debug(f'Done. Execution took: {compute_time:.1f} s')
+
+    # Consolidate metadata so readers fetch the metadata of all arrays in one read
+    zarr.consolidate_metadata(out_zarr)
 
 
 def _rechunk_for_time_command(args):
@@ -103,8 +123,9 @@ def _add_rechunk_for_time_arguments(parser):
                         help="Path to address where output Zarr dataset will be written.")
     parser.add_argument("temp_zarr",
                         help="Path to address where a temporary intermediate Zarr dataset will be written.")
-    parser.add_argument("-m", "--max_memory", type=str, default="100MB",
-                        help='Maximum in-memory size of chunk. Defaults to "100MB".')
+    parser.add_argument("-m", "--max_memory", type=str, default=None,
+                        help='Maximum in-memory size of chunk per worker (e.g. "500MB"). There is one worker per '
+                             'core. Defaults to half of the available memory split between the workers.')
     parser.add_argument("-d" "--debug", dest="debug", action='store_true',
                         help="Turn on debug logging.")
     parser.set_defaults(func=_rechunk_for_time_command)
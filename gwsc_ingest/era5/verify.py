@@ -1,5 +1,8 @@
 import datetime as dt
 import logging
+import os
+
+import pandas as pd
 
 from gwsc_ingest.era5.download import bulk_download_one_day_ran_sfc
 from gwsc_ingest.utils.logging import setup_basic_logging
@@ -17,7 +20,7 @@ def check_and_download(dir_with_files, download_missing=False, processes=1, api_
     Args:
         dir_with_files (path): Path to directory with files to verify.
         download_missing (bool): Download missing files if True. Defaults to False.
-        processes (int): Number of concurrent processes to use to download the data.
+        processes (int): Number of concurrent downloads.
         api_key (str): CDS API Key. Attempts to read from ~/.cdsapirc file if not provided.
     """
     missing_dates = check_for_missing_files(dir_with_files=dir_with_files, return_dates=True)
@@ -51,37 +54,35 @@ def check_for_missing_files(dir_with_files, return_dates=False):
     dir_with_files = validate_directory(dir_with_files, 'download_dir')
     log.info(f'Checking files in directory: {dir_with_files}')
 
-    files_found = sorted(dir_with_files.iterdir())
+    # Compare file names as plain strings: the directory entries cache their type, so no extra stat calls are made,
+    # and Paths are only built for the missing files
+    with os.scandir(dir_with_files) as entries:
+        files_found = sorted(entry.name for entry in entries if entry.is_file() and entry.name.endswith('.nc'))
     log.info(f'Number of Files: {len(files_found)}')
 
     first_file = files_found[0]
     last_file = files_found[-1]
-    log.info(f'First File: {first_file}')
-    log.info(f'Last File: {last_file}')
+    log.info(f'First File: {dir_with_files / first_file}')
+    log.info(f'Last File: {dir_with_files / last_file}')
 
     date_format_str = 'reanalysis-era5-single-levels-24-hours-%Y-%m-%d'
-    first_date = dt.datetime.strptime(first_file.stem, date_format_str)
-    last_date = dt.datetime.strptime(last_file.stem, date_format_str)
+    first_date = dt.datetime.strptime(os.path.splitext(first_file)[0], date_format_str)
+    last_date = dt.datetime.strptime(os.path.splitext(last_file)[0], date_format_str)
     log.info(f'First Date: {first_date}')
     log.info(f'Last Date: {last_date}')
 
-    curr_date = first_date
-    expected_files = set()
-    while curr_date <= last_date:
-        expected_files.add(dir_with_files / f'{curr_date.strftime(date_format_str)}.nc')
-        curr_date += dt.timedelta(days=1)
+    expected_files = set(pd.date_range(first_date, last_date, freq='D').strftime(f'{date_format_str}.nc'))
 
-    files_found = set(files_found)
     diff_files = expected_files.difference(files_found)
     log.info(f'Number of Missing Files: {len(diff_files)}')
     sorted_dif_files = sorted(diff_files)
     log.debug(f'Missing Files: {sorted_dif_files}')
 
     if not return_dates:
-        return diff_files
+        return {dir_with_files / name for name in diff_files}
 
     else:
-        return [dt.datetime.strptime(p.stem, date_format_str) for p in diff_files]
+        return pd.to_datetime(list(diff_files), format=f'{date_format_str}.nc').to_pydatetime().tolist()
 
 
 def _verify_command(args):
@@ -101,7 +102,7 @@ def _add_verify_parser_arguments(parser):
     parser.add_argument("-d", "--download-missing", dest="download_missing", action='store_true',
                         help="Download missing files.")
     parser.add_argument("-p" "--processes", dest="processes", type=int, required=False, default=1,
-                        help="Number of concurrent processes to use to download the files.")
+                        help="Number of concurrent downloads.")
     parser.add_argument("-k" "--key", dest="key", type=str, required=False, default=None,
                         help="CDS API Key")
     parser.add_argument("-d" "--debug", dest="debug", action='store_true',
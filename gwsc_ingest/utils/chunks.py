@@ -0,0 +1,42 @@
+import math
+
+
+def get_time_contiguous_chunks(da, target_chunk_size=1.049e8):
+    """
+    Derive chunk sizes that put all time steps of a grid cell in the same chunk, with spatial chunks of at most the
+        target size. The spatial chunk sizes are divisors of the latitude and longitude sizes, so every chunk has the
+        same shape (e.g. factors of 721 = 1 x 7 x 103 and factors of 1440 = 1 x 2^5 x 3^2 x 5).
+
+    Args:
+        da (xr.DataArray): The xr.DataArray with dimensions "time", "latitude", and "longitude" to chunk.
+        target_chunk_size (float): Target size per chunk in bytes. Defaults to 100 MB (1.049e8).
+
+    Returns:
+        dict: Chunk size of each dimension.
+    """
+    cell_size = da.sizes['time'] * da.dtype.itemsize
+    cells_per_chunk = max(1, int(target_chunk_size // cell_size))
+
+    # Start from square chunks, then widen the longitude chunks to make up for latitude chunks that were snapped down
+    edge = max(1, int(math.sqrt(cells_per_chunk)))
+    latitude_chunks = _largest_divisor(da.sizes['latitude'], edge)
+    longitude_chunks = _largest_divisor(da.sizes['longitude'], max(1, cells_per_chunk // latitude_chunks))
+    return {
+        'time': da.sizes['time'],
+        'latitude': latitude_chunks,
+        'longitude': longitude_chunks,
+    }
+
+
+def _largest_divisor(n, limit):
+    """
+    Get the largest divisor of n that is no greater than limit.
+
+    Args:
+        n (int): The number to divide.
+        limit (int): The upper limit of the divisor (at least 1).
+
+    Returns:
+        int: The largest divisor.
+    """
+    return max(d for d in range(1, min(n, limit) + 1) if n % d == 0)
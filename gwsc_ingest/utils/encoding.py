@@ -0,0 +1,50 @@
+from numcodecs import Blosc
+import numpy as np
+
+# Summary variables are packed into 16-bit integers on write: temperature with 0.01 C precision
+# and precipitation with 0.1 mm precision. xarray unpacks them transparently on read. The daily summary files, the
+# Zarr store built from them, and the normals computed from it are all packed the same way.
+_TEMPERATURE_ENCODING = {
+    'dtype': 'int16',
+    'scale_factor': np.float32(0.01),
+    'add_offset': np.float32(0.0),
+    '_FillValue': np.int16(-32768),
+}
+_PRECIPITATION_ENCODING = {
+    'dtype': 'int16',
+    'scale_factor': np.float32(0.1),
+    'add_offset': np.float32(0.0),
+    '_FillValue': np.int16(-32768),
+}
+DAILY_ENCODING = {
+    'mean_t2m_c': _TEMPERATURE_ENCODING,
+    'max_t2m_c': _TEMPERATURE_ENCODING,
+    'min_t2m_c': _TEMPERATURE_ENCODING,
+    'sum_tp_mm': _PRECIPITATION_ENCODING,
+}
+
+# Compressor of all Zarr datasets. Zstandard with bit shuffling compresses the smooth temperature and precipitation
+# fields better than the default LZ4.
+ZARR_COMPRESSOR = Blosc(cname='zstd', clevel=3, shuffle=Blosc.BITSHUFFLE)
+
+
+def cast_packed_to_float32(ds):
+    """
+    Cast the int16-packed variables of a Zarr dataset written by netcdf_to_zarr back to float32 after decoding.
+        Zarr stores the scale factors as JSON doubles, so xarray decodes the packed variables to float64, twice the
+        size of the float32 daily summaries. The encoding of each variable is kept, so it is packed the same way
+        when written again.
+
+    Args:
+        ds (xr.Dataset): Dataset opened from a Zarr dataset with xr.open_zarr.
+
+    Returns:
+        xr.Dataset: Dataset with the packed variables as float32.
+    """
+    ds = ds.copy()
+    for var in ds.data_vars:
+        if 'scale_factor' in ds[var].encoding and ds[var].dtype == np.float64:
+            encoding = ds[var].encoding
+            ds[var] = ds[var].astype(np.float32)
+            ds[var].encoding = encoding
+    return ds
@@ -0,0 +1,22 @@
+def combine_expver(ds):
+    """
+    Combine the ERA5 and ERA5T data of a dataset with an expver dimension into a single dataset without it.
+        ERA5 data is assigned experiment version (expver) 1, while ERA5T expver is 5. The CDS adds the expver
+        dimension to the whole file whenever a request mixes both, and each time step is valid in only one of the
+        versions, so every time step is taken from ERA5 where it has data and from ERA5T otherwise.
+        See: https://confluence.ecmwf.int/display/CUSF/ERA5+CDS+requests+which+return+a+mixture+of+ERA5+and+ERA5T+data
+
+    Args:
+        ds (xr.Dataset): Hourly dataset with an expver dimension.
+
+    Returns:
+        xr.Dataset: Dataset without the expver dimension, with the attributes and encoding of the given dataset.
+            Lazy if the given dataset is.
+    """
+    era5 = ds.sel(expver=1, drop=True)
+    era5t = ds.sel(expver=5, drop=True)
+    combined = era5.combine_first(era5t)
+    for var in combined.data_vars:
+        combined[var].attrs = ds[var].attrs
+        combined[var].encoding = ds[var].encoding
+    return combined
@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+import os
+from pathlib import Path
+
+
+@contextmanager
+def atomic_output_path(out_path):
+    """
+    Provide a temporary path next to the given output path to write a file to. The file is moved to the output path
+        once the block completes, so an interrupted write never leaves a truncated file that looks like a finished
+        one. The temporary file is removed if the block fails.
+
+    Args:
+        out_path (str or pathlib.Path): Path to the file to write.
+
+    Yields:
+        pathlib.Path: Temporary path to write the file to, the output path with a ".part" suffix.
+    """
+    out_path = Path(out_path)
+    part_path = out_path.with_name(out_path.name + '.part')
+    try:
+        yield part_path
+        os.replace(part_path, out_path)
+    finally:
+        part_path.unlink(missing_ok=True)
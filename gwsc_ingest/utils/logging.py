@@ -20,9 +20,13 @@ class GwscConsoleFormatter(logging.Formatter):
     """
     Format messages differently based on log level.
     """
+    def __init__(self):
+        super().__init__()
+        # One formatter per format, instead of swapping the format on each record, which isn't thread-safe
+        self._info_formatter = logging.Formatter("%(message)s")
+        self._other_formatter = logging.Formatter("%(levelname)s: %(message)s")
+
     def format(self, record):
         if record.levelno == logging.INFO:
-            self._style._fmt = "%(message)s"
-        else:
-            self._style._fmt = "%(levelname)s: %(message)s"
-        return super().format(record)
+            return self._info_formatter.format(record)
+        return self._other_formatter.format(record)
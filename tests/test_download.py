@@ -0,0 +1,47 @@
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from gwsc_ingest.era5.download import _get_out_paths, _split_days
+
+
+def test_split_days_mixed_expver(tmp_path):
+    # A month requested across the ERA5/ERA5T boundary: the CDS adds expver to the whole file, with ERA5 (expver 1)
+    # valid until 2020-01-02 06:00 and ERA5T (expver 5) valid afterwards
+    times = pd.date_range('2020-01-01', periods=72, freq='h')
+    era5_hours = 24 + 7
+    t2m = np.full((2, len(times), 3, 4), np.nan, dtype=np.float32)
+    t2m[0, :era5_hours] = 273.15
+    t2m[1, era5_hours:] = 274.15
+    ds = xr.Dataset(
+        {
+            't2m': (('expver', 'time', 'latitude', 'longitude'), t2m, {'units': 'K'}),
+            'tp': (('expver', 'time', 'latitude', 'longitude'), np.where(np.isnan(t2m), np.nan, 0.001),
+                   {'units': 'm'}),
+        },
+        coords={
+            'expver': [1, 5],
+            'time': times,
+            'latitude': np.array([10.0, 9.75, 9.5], dtype=np.float32),
+            'longitude': np.array([0.0, 0.25, 0.5, 0.75], dtype=np.float32),
+        },
+    )
+    in_path = tmp_path / 'reanalysis-era5-single-levels-2020-01.nc'
+    ds.to_netcdf(in_path)
+    days = [dt.datetime(2020, 1, 1) + dt.timedelta(days=i) for i in range(3)]
+    out_paths = _get_out_paths(days, tmp_path, 'netcdf')
+
+    _split_days(in_path, out_paths)
+
+    for day, out_path in out_paths.items():
+        with xr.open_dataset(out_path) as day_ds:
+            assert 'expver' not in day_ds.dims
+            assert day_ds.sizes['time'] == 24
+            assert day_ds['t2m'].attrs['units'] == 'K'
+            assert not np.isnan(day_ds['t2m'].values).any()
+            assert not np.isnan(day_ds['tp'].values).any()
+    with xr.open_dataset(out_paths[days[1]]) as day_ds:
+        np.testing.assert_allclose(day_ds['t2m'].values[:7], 273.15)
+        np.testing.assert_allclose(day_ds['t2m'].values[7:], 274.15)
@@ -0,0 +1,26 @@
+import pytest
+
+from gwsc_ingest.utils.files import atomic_output_path
+
+
+def test_atomic_output_path(tmp_path):
+    out_path = tmp_path / 'out.nc'
+
+    with atomic_output_path(out_path) as part_path:
+        part_path.write_bytes(b'data')
+        assert not out_path.exists()
+
+    assert out_path.read_bytes() == b'data'
+    assert not part_path.exists()
+
+
+def test_atomic_output_path_interrupted(tmp_path):
+    out_path = tmp_path / 'out.nc'
+
+    with pytest.raises(RuntimeError):
+        with atomic_output_path(out_path) as part_path:
+            part_path.write_bytes(b'partial')
+            raise RuntimeError('interrupted')
+
+    assert not out_path.exists()
+    assert not part_path.exists()
@@ -0,0 +1,101 @@
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from gwsc_ingest.era5.generate_daily_dataset import bulk_generate_daily_datasets, generate_daily_datasets
+
+
+def _write_hourly_file(directory, day, t2m_k, tp_m):
+    """
+    Write a small ERA5-like hourly file with constant t2m and tp values.
+    """
+    times = pd.date_range(day, periods=24, freq='h')
+    shape = (24, 3, 4)
+    ds = xr.Dataset(
+        {
+            't2m': (('time', 'latitude', 'longitude'), np.full(shape, t2m_k, dtype=np.float32),
+                    {'long_name': '2 metre temperature', 'units': 'K'}),
+            'tp': (('time', 'latitude', 'longitude'), np.full(shape, tp_m, dtype=np.float32),
+                   {'long_name': 'Total precipitation', 'units': 'm'}),
+        },
+        coords={
+            'time': times,
+            'latitude': np.array([10.0, 9.75, 9.5], dtype=np.float32),
+            'longitude': np.array([0.0, 0.25, 0.5, 0.75], dtype=np.float32),
+        },
+    )
+    path = directory / f'reanalysis-era5-single-levels-24-hours-{day:%Y-%m-%d}.nc'
+    ds.to_netcdf(path, engine='h5netcdf')
+    return path
+
+
+def test_bulk_generate_daily_datasets_concurrent_files(tmp_path):
+    in_dir = tmp_path / 'hourly'
+    out_dir = tmp_path / 'daily'
+    in_dir.mkdir()
+    out_dir.mkdir()
+    days = [dt.datetime(2020, 1, 1) + dt.timedelta(days=i) for i in range(4)]
+    for i, day in enumerate(days):
+        _write_hourly_file(in_dir, day, t2m_k=273.15 + i, tp_m=0.001)
+
+    # Several files at once, so the reduction kernel runs from concurrent threads
+    bulk_generate_daily_datasets(in_dir, out_dir, processes=len(days))
+
+    for i, day in enumerate(days):
+        out_file = out_dir / f'reanalysis-era5-sfc-daily-{day:%Y-%m-%d}.nc'
+        with xr.open_dataset(out_file) as ds:
+            np.testing.assert_allclose(ds.mean_t2m_c.values, i, atol=0.01)
+            np.testing.assert_allclose(ds.min_t2m_c.values, i, atol=0.01)
+            np.testing.assert_allclose(ds.max_t2m_c.values, i, atol=0.01)
+            np.testing.assert_allclose(ds.sum_tp_mm.values, 24.0, atol=0.1)
+
+
+def test_bulk_generate_daily_datasets_skips_unexpected_names(tmp_path):
+    in_dir = tmp_path / 'hourly'
+    out_dir = tmp_path / 'daily'
+    in_dir.mkdir()
+    out_dir.mkdir()
+    day = dt.datetime(2020, 1, 1)
+    _write_hourly_file(in_dir, day, t2m_k=273.15, tp_m=0.001)
+    (in_dir / 'notes.nc').write_bytes(b'')
+
+    bulk_generate_daily_datasets(in_dir, out_dir, processes=1)
+
+    assert [p.name for p in out_dir.iterdir()] == [f'reanalysis-era5-sfc-daily-{day:%Y-%m-%d}.nc']
+
+
+@pytest.mark.parametrize('era5_hours', [24, 7, 0])
+def test_generate_daily_datasets_mixed_expver(tmp_path, era5_hours):
+    # ERA5 (expver 1) has data for the first hours of the day and ERA5T (expver 5) for the rest, NaN otherwise.
+    # 24 is a pure ERA5 day of a month that was requested together with ERA5T days.
+    day = dt.datetime(2020, 1, 1)
+    t2m = np.full((2, 24, 3, 4), np.nan, dtype=np.float32)
+    t2m[0, :era5_hours] = 273.15
+    t2m[1, era5_hours:] = 273.15
+    tp = np.where(np.isnan(t2m), np.nan, 0.001).astype(np.float32)
+    ds = xr.Dataset(
+        {
+            't2m': (('expver', 'time', 'latitude', 'longitude'), t2m,
+                    {'long_name': '2 metre temperature', 'units': 'K'}),
+            'tp': (('expver', 'time', 'latitude', 'longitude'), tp,
+                   {'long_name': 'Total precipitation', 'units': 'm'}),
+        },
+        coords={
+            'expver': [1, 5],
+            'time': pd.date_range(day, periods=24, freq='h'),
+            'latitude': np.array([10.0, 9.75, 9.5], dtype=np.float32),
+            'longitude': np.array([0.0, 0.25, 0.5, 0.75], dtype=np.float32),
+        },
+    )
+    in_file = tmp_path / f'reanalysis-era5-single-levels-24-hours-{day:%Y-%m-%d}.nc'
+    ds.to_netcdf(in_file, engine='h5netcdf')
+    out_file = tmp_path / 'daily.nc'
+
+    generate_daily_datasets(str(in_file), str(out_file))
+
+    with xr.open_dataset(out_file) as ds:
+        np.testing.assert_allclose(ds.mean_t2m_c.values, 0.0, atol=0.01)
+        np.testing.assert_allclose(ds.sum_tp_mm.values, 24.0, atol=0.1)
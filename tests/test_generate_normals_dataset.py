@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from gwsc_ingest.era5.generate_normals_dataset import generate_normals_dataset
+
+
+def _write_daily_zarr(path, start, end):
+    """
+    Write a small daily summary Zarr dataset with a constant mean temperature of 10 C.
+    """
+    times = pd.date_range(start, end, freq='D')
+    ds = xr.Dataset(
+        {
+            'mean_t2m_c': (('time', 'latitude', 'longitude'), np.full((len(times), 2, 3), 10.0, dtype=np.float32),
+                           {'units': 'C'}),
+        },
+        coords={
+            'time': times,
+            'latitude': np.array([10.0, 9.75], dtype=np.float32),
+            'longitude': np.array([0.0, 0.25, 0.5], dtype=np.float32),
+        },
+    )
+    ds.chunk({'time': 100}).to_zarr(path, mode='w', consolidated=True)
+
+
+def test_generate_normals_dataset_without_leap_year(tmp_path):
+    in_zarr = tmp_path / 'daily.zarr'
+    out_dir = tmp_path / 'normals'
+    out_dir.mkdir()
+    _write_daily_zarr(in_zarr, '2001-01-01', '2003-12-31')
+
+    generate_normals_dataset(str(in_zarr), out_dir, variables=['mean_t2m_c'])
+
+    # No leap year in the reference period: no DOY 366 output (2000-12-31)
+    out_files = sorted(out_dir.glob('reanalysis-era5-normal-pnt-*.nc'))
+    assert len(out_files) == 365
+    assert not (out_dir / 'reanalysis-era5-normal-pnt-2000-12-31.nc').exists()
+
+    with xr.open_dataset(out_files[0]) as ds:
+        assert ds['doy'].values.tolist() == [1]
+        np.testing.assert_allclose(ds['normal_mean_t2m_c'].values, 10.0, atol=0.01)
+
+
+def test_generate_normals_dataset_concurrent_writes(tmp_path):
+    in_zarr = tmp_path / 'daily.zarr'
+    out_dir = tmp_path / 'normals'
+    out_dir.mkdir()
+    _write_daily_zarr(in_zarr, '2000-01-01', '2001-01-22')
+
+    # Several threads, so the per-DOY files are written concurrently
+    generate_normals_dataset(str(in_zarr), out_dir, variables=['mean_t2m_c'], processes=4)
+
+    out_files = sorted(out_dir.glob('reanalysis-era5-normal-pnt-*.nc'))
+    assert len(out_files) == 366
+    for out_file in out_files:
+        with xr.open_dataset(out_file) as ds:
+            np.testing.assert_allclose(ds['normal_mean_t2m_c'].values, 10.0, atol=0.01)
+
+
+def test_generate_normals_dataset_zarr_without_leap_year(tmp_path):
+    in_zarr = tmp_path / 'daily.zarr'
+    out_dir = tmp_path / 'normals'
+    out_dir.mkdir()
+    _write_daily_zarr(in_zarr, '2001-01-01', '2003-12-31')
+
+    generate_normals_dataset(str(in_zarr), out_dir, variables=['mean_t2m_c'], out_format='zarr')
+
+    with xr.open_zarr(out_dir / 'reanalysis-era5-normal-pnt.zarr') as ds:
+        assert ds.sizes['time'] == 365
+        assert int(ds['doy'].max()) == 365
+        assert not np.isnan(ds['normal_mean_t2m_c'].values).any()
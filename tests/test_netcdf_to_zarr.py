@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from gwsc_ingest.era5.netcdf_to_zarr import netcdf_to_zarr
+from gwsc_ingest.utils.encoding import DAILY_ENCODING
+
+
+def _write_daily_file(directory, day, rng):
+    """
+    Write a small daily summary file packed like the files written by era5-gen-daily-ds. Returns the dataset written.
+    """
+    shape = (1, 3, 4)
+    ds = xr.Dataset(
+        {var: (('time', 'latitude', 'longitude'), rng.uniform(-20.0, 40.0, shape).astype(np.float32))
+         for var in ('mean_t2m_c', 'max_t2m_c', 'min_t2m_c')},
+        coords={
+            'time': [day],
+            'latitude': np.array([10.0, 9.75, 9.5], dtype=np.float32),
+            'longitude': np.array([0.0, 0.25, 0.5, 0.75], dtype=np.float32),
+        },
+    )
+    ds['sum_tp_mm'] = (('time', 'latitude', 'longitude'), rng.uniform(0.0, 50.0, shape).astype(np.float32))
+    encoding = {var: dict(DAILY_ENCODING[var]) for var in ds.data_vars}
+    ds.to_netcdf(directory / f'reanalysis-era5-sfc-daily-{day:%Y-%m-%d}.nc', engine='h5netcdf', encoding=encoding)
+    return ds
+
+
+def test_netcdf_to_zarr(tmp_path):
+    in_dir = tmp_path / 'daily'
+    in_dir.mkdir()
+    out_zarr = tmp_path / 'daily.zarr'
+    rng = np.random.default_rng(0)
+    days = pd.date_range('2020-01-01', periods=5, freq='D')
+    expected = xr.concat([_write_daily_file(in_dir, day, rng) for day in days], 'time')
+
+    # Small chunks, so the store is written by several region writes, the last one partial
+    netcdf_to_zarr(in_dir, str(out_zarr), size_per_chunk=400)
+
+    with xr.open_zarr(out_zarr) as ds:
+        assert ds.sizes['time'] == len(days)
+        np.testing.assert_array_equal(ds['time'].values, days.values)
+        assert ds['mean_t2m_c'].chunks[0] == (3, 2)
+        for var in expected.data_vars:
+            assert ds[var].encoding['dtype'] == np.int16
+            np.testing.assert_allclose(ds[var].values, expected[var].values,
+                                       atol=float(DAILY_ENCODING[var]['scale_factor']))